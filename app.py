@@ -5,6 +5,10 @@ import altair as alt
 import pandas as pd
 from utilities import (
     scrape_films_details,
+    build_films_details,
+    concat_cached_and_scraped,
+    films_fingerprint,
+    open_details_cache,
     scrape_films,
     DOMAIN,
     classify_popularity,
@@ -17,107 +21,136 @@ from sklearn.preprocessing import StandardScaler
 
 scaler = StandardScaler()
 
-current_dir = Path(__file__).parent if "__file__" in locals() else Path.cwd()
-css_file = current_dir / "styles" / "main.css"
-st.set_page_config(
-    page_icon="📽️",
-    page_title="Letterboxd Analysis",
-    layout="wide",
-)
-with open(css_file) as f:
-    st.markdown("<style>{}</style>".format(f.read()), unsafe_allow_html=True)
 
-st.title("📽️ Letterboxd Profile Analyzer")
-st.write(
-    "See how you rate your movies, what movies you like, the genres, the actors and directors of those movies 🍿."
-)
+def merge_film_ratings(df_film, df_rating):
+    df_rating["runtime_group"] = classify_runtime(df_rating["runtime"])
+    df_rating["ltw_ratio"] = df_rating["liked_by"] / df_rating["watched_by"]
+    df_rating["popularity"] = classify_popularity(df_rating["watched_by"])
+    df_rating["likeability"] = classify_likeability(df_rating["ltw_ratio"])
+    df_rating_merged = pd.merge(df_film, df_rating, left_on="id", right_on="id")
+    df_rating_merged["difference"] = (
+        df_rating_merged["rating"] - df_rating_merged["avg_rating"]
+    )
+    df_rating_merged["difference_abs"] = abs(df_rating_merged["difference"])
+    return df_rating_merged
 
-username = st.text_input("Letterboxd Username")
-row_button = st.columns((6, 1, 1, 6))
-submit = row_button[1].button("Submit")
 
-if submit:
-    # scraping process
-    df_film = scrape_films(username)
-    df_film = df_film[df_film["rating"] != -1].reset_index(drop=True)
-    st.write("You have {0} movies to scrape".format(len(df_film)))
-    df_rating, df_actor, df_director, df_genre, df_theme, df_country, df_language = (
-        scrape_films_details(df_film, username)
-    )
+def render_rating_comparison(df_rating_merged):
+    if df_rating_merged["difference"].mean() > 0:
+        ave_rat = "higher"
+    else:
+        ave_rat = "lower"
 
-    st.write("---")
     st.markdown(
-        "<h1 style='text-align:center;'>👤 {0}'s Profile Analysis</h1>".format(
-            username
-        ),
-        unsafe_allow_html=True,
-    )
-    st.write("")
-    row_df = st.columns(3)
-    with row_df[0]:
-        st.markdown(
-            div(
-                style=styles(
-                    text_align="center",
-                    padding=(rem(1), 0, rem(2), 0),
-                )
-            )(
-                h2(style=styles(font_size=rem(2), padding=0))("👁️ Rated Movies"),
-                big(style=styles(font_size=rem(5), font_weight=600, line_height=1))(
-                    len(df_film)
-                ),
-            ),
-            unsafe_allow_html=True,
+        """
+    It looks like on average you rated movies **{}** than the average Letterboxd user, **by about {} points**.
+    You differed from the crowd most on the movie **[{}]({})** where you rated the movie {} stars while the general users rated the movie {}.
+    """.format(
+            ave_rat,
+            abs(round(df_rating_merged["difference"].mean(), 2)),
+            df_rating_merged[
+                df_rating_merged["difference_abs"]
+                == df_rating_merged["difference_abs"].max()
+            ]["title"].values[0],
+            DOMAIN
+            + df_rating_merged[
+                df_rating_merged["difference_abs"]
+                == df_rating_merged["difference_abs"].max()
+            ]["link"].values[0],
+            df_rating_merged[
+                df_rating_merged["difference_abs"]
+                == df_rating_merged["difference_abs"].max()
+            ]["rating"].values[0],
+            df_rating_merged[
+                df_rating_merged["difference_abs"]
+                == df_rating_merged["difference_abs"].max()
+            ]["avg_rating"].values[0],
         )
-    with row_df[1]:
-        st.markdown(
-            div(
-                style=styles(
-                    text_align="center",
-                    padding=(rem(1), 0, rem(2), 0),
-                )
-            )(
-                h2(style=styles(font_size=rem(2), padding=0))("❤️ Liked Movies"),
-                big(style=styles(font_size=rem(5), font_weight=600, line_height=1))(
-                    len(df_film[df_film["liked"] == True])
-                ),
-            ),
-            unsafe_allow_html=True,
+    )
+    with st.expander("Movies You Under Rated"):
+        st.dataframe(
+            df_rating_merged.sort_values("difference")
+            .reset_index(drop=True)
+            .shift()[1:]
+            .head(5)[["rating", "avg_rating", "liked", "title"]],
+            use_container_width=True,
         )
-    with row_df[2]:
-        st.markdown(
-            div(
-                style=styles(
-                    text_align="center",
-                    padding=(rem(1), 0, rem(2), 0),
-                )
-            )(
-                h2(style=styles(font_size=rem(2), padding=0))("⭐ Average Ratings"),
-                big(style=styles(font_size=rem(5), font_weight=600, line_height=1))(
-                    round(df_film["rating"].mean(), 2)
-                ),
-            ),
-            unsafe_allow_html=True,
+    with st.expander("Movies You Over Rated"):
+        st.dataframe(
+            df_rating_merged.sort_values("difference", ascending=False)
+            .reset_index(drop=True)
+            .shift()[1:]
+            .head(5)[["rating", "avg_rating", "liked", "title"]],
+            use_container_width=True,
         )
 
-    df_rating["runtime_group"] = df_rating.apply(
-        lambda row: classify_runtime(row["runtime"]), axis=1
-    )
-    df_rating["ltw_ratio"] = df_rating["liked_by"] / df_rating["watched_by"]
-    df_rating["popularity"] = df_rating.apply(
-        lambda row: classify_popularity(row["watched_by"]), axis=1
-    )
-    df_rating["likeability"] = df_rating.apply(
-        lambda row: classify_likeability(row["ltw_ratio"]), axis=1
+
+def render_users_rating(df_rating_merged):
+    st.altair_chart(
+        alt.Chart(df_rating_merged)
+        .mark_bar(tooltip=True)
+        .encode(
+            alt.X("avg_rating", bin=True, axis=alt.Axis(labelAngle=0)),
+            y="count()",
+            color=alt.Color(
+                "liked",
+                scale=alt.Scale(domain=[True, False], range=["#ff8000", "#00b020"]),
+            ),
+        ),
+        use_container_width=True,
     )
-    df_rating_merged = pd.merge(df_film, df_rating, left_on="id", right_on="id")
-    df_rating_merged["rating"] = df_rating_merged["rating"].astype(float)
-    df_rating_merged["avg_rating"] = df_rating_merged["avg_rating"].astype(float)
-    df_rating_merged["difference"] = (
-        df_rating_merged["rating"] - df_rating_merged["avg_rating"]
+    st.markdown(
+        """
+    Here is the distribution of average rating by other Letterboxd users for the movies that you've rated. Your movie with the lowest average
+    rating is **[{}]({})** ({}) with {}, the highest is **[{}]({})** ({}) with {}.
+    """.format(
+            df_rating_merged[
+                df_rating_merged["avg_rating"] == df_rating_merged["avg_rating"].min()
+            ]["title"].values[0],
+            DOMAIN
+            + df_rating_merged[
+                df_rating_merged["avg_rating"] == df_rating_merged["avg_rating"].min()
+            ]["link"].values[0],
+            df_rating_merged[
+                df_rating_merged["avg_rating"] == df_rating_merged["avg_rating"].min()
+            ]["year"].values[0],
+            df_rating_merged[
+                df_rating_merged["avg_rating"] == df_rating_merged["avg_rating"].min()
+            ]["avg_rating"].values[0],
+            df_rating_merged[
+                df_rating_merged["avg_rating"] == df_rating_merged["avg_rating"].max()
+            ]["title"].values[0],
+            DOMAIN
+            + df_rating_merged[
+                df_rating_merged["avg_rating"] == df_rating_merged["avg_rating"].max()
+            ]["link"].values[0],
+            df_rating_merged[
+                df_rating_merged["avg_rating"] == df_rating_merged["avg_rating"].max()
+            ]["year"].values[0],
+            df_rating_merged[
+                df_rating_merged["avg_rating"] == df_rating_merged["avg_rating"].max()
+            ]["avg_rating"].values[0],
+        )
     )
-    df_rating_merged["difference_abs"] = abs(df_rating_merged["difference"])
+    with st.expander("Lowest Rated Movies"):
+        st.dataframe(
+            df_rating_merged.sort_values("avg_rating")
+            .reset_index(drop=True)
+            .shift()[1:]
+            .head(5)[["rating", "avg_rating", "liked", "title"]],
+            use_container_width=True,
+        )
+    with st.expander("Highest Rated Movies"):
+        st.dataframe(
+            df_rating_merged.sort_values("avg_rating", ascending=False)
+            .reset_index(drop=True)
+            .shift()[1:]
+            .head(5)[["rating", "avg_rating", "liked", "title"]],
+            use_container_width=True,
+        )
+
 
+def render_rating_sections(df_rating_merged):
     st.write("")
     row_year = st.columns(2)
 
@@ -142,7 +175,7 @@ if submit:
         Looks like the average release date is around **{}**, with your oldest movie being **[{}]({})** ({}) and your latest being **[{}]({})** ({}).
         Your movies mostly were released in {}.
         """.format(
-                round(df_rating_merged["year"].astype(float).mean()),
+                round(df_rating_merged["year"].mean()),
                 df_rating_merged["title"].values[-1],
                 DOMAIN + df_rating_merged["link"].values[-1],
                 df_rating_merged["year"].values[-1],
@@ -269,148 +302,6 @@ if submit:
             )
     st.write("")
 
-    row_rating = st.columns(2)
-
-    with row_rating[0]:
-        st.subheader("How Do You Rate Your Movies?")
-        st.write("")
-        df_film["rating"] = df_film["rating"].astype(str)
-        st.altair_chart(
-            alt.Chart(df_film)
-            .mark_bar(tooltip=True)
-            .encode(
-                alt.X("rating", axis=alt.Axis(labelAngle=0)),
-                y="count()",
-                color=alt.Color(
-                    "liked",
-                    scale=alt.Scale(domain=[True, False], range=["#ff8000", "#00b020"]),
-                ),
-            ),
-            use_container_width=True,
-        )
-
-        if df_rating_merged["difference"].mean() > 0:
-            ave_rat = "higher"
-        else:
-            ave_rat = "lower"
-
-        st.markdown(
-            """
-        It looks like on average you rated movies **{}** than the average Letterboxd user, **by about {} points**.
-        You differed from the crowd most on the movie **[{}]({})** where you rated the movie {} stars while the general users rated the movie {}.
-        """.format(
-                ave_rat,
-                abs(round(df_rating_merged["difference"].mean(), 2)),
-                df_rating_merged[
-                    df_rating_merged["difference_abs"]
-                    == df_rating_merged["difference_abs"].max()
-                ]["title"].values[0],
-                DOMAIN
-                + df_rating_merged[
-                    df_rating_merged["difference_abs"]
-                    == df_rating_merged["difference_abs"].max()
-                ]["link"].values[0],
-                df_rating_merged[
-                    df_rating_merged["difference_abs"]
-                    == df_rating_merged["difference_abs"].max()
-                ]["rating"].values[0],
-                df_rating_merged[
-                    df_rating_merged["difference_abs"]
-                    == df_rating_merged["difference_abs"].max()
-                ]["avg_rating"].values[0],
-            )
-        )
-        with st.expander("Movies You Under Rated"):
-            st.dataframe(
-                df_rating_merged.sort_values("difference")
-                .reset_index(drop=True)
-                .shift()[1:]
-                .head(5)[["rating", "avg_rating", "liked", "title"]],
-                use_container_width=True,
-            )
-        with st.expander("Movies You Over Rated"):
-            st.dataframe(
-                df_rating_merged.sort_values("difference", ascending=False)
-                .reset_index(drop=True)
-                .shift()[1:]
-                .head(5)[["rating", "avg_rating", "liked", "title"]],
-                use_container_width=True,
-            )
-
-    with row_rating[1]:
-        st.subheader("How Do Letterboxd Users Rate Your Movies?")
-        st.write("")
-        st.altair_chart(
-            alt.Chart(df_rating_merged)
-            .mark_bar(tooltip=True)
-            .encode(
-                alt.X("avg_rating", bin=True, axis=alt.Axis(labelAngle=0)),
-                y="count()",
-                color=alt.Color(
-                    "liked",
-                    scale=alt.Scale(domain=[True, False], range=["#ff8000", "#00b020"]),
-                ),
-            ),
-            use_container_width=True,
-        )
-        st.markdown(
-            """
-        Here is the distribution of average rating by other Letterboxd users for the movies that you've rated. Your movie with the lowest average
-        rating is **[{}]({})** ({}) with {}, the highest is **[{}]({})** ({}) with {}.
-        """.format(
-                df_rating_merged[
-                    df_rating_merged["avg_rating"]
-                    == df_rating_merged["avg_rating"].min()
-                ]["title"].values[0],
-                DOMAIN
-                + df_rating_merged[
-                    df_rating_merged["avg_rating"]
-                    == df_rating_merged["avg_rating"].min()
-                ]["link"].values[0],
-                df_rating_merged[
-                    df_rating_merged["avg_rating"]
-                    == df_rating_merged["avg_rating"].min()
-                ]["year"].values[0],
-                df_rating_merged[
-                    df_rating_merged["avg_rating"]
-                    == df_rating_merged["avg_rating"].min()
-                ]["avg_rating"].values[0],
-                df_rating_merged[
-                    df_rating_merged["avg_rating"]
-                    == df_rating_merged["avg_rating"].max()
-                ]["title"].values[0],
-                DOMAIN
-                + df_rating_merged[
-                    df_rating_merged["avg_rating"]
-                    == df_rating_merged["avg_rating"].max()
-                ]["link"].values[0],
-                df_rating_merged[
-                    df_rating_merged["avg_rating"]
-                    == df_rating_merged["avg_rating"].max()
-                ]["year"].values[0],
-                df_rating_merged[
-                    df_rating_merged["avg_rating"]
-                    == df_rating_merged["avg_rating"].max()
-                ]["avg_rating"].values[0],
-            )
-        )
-        with st.expander("Lowest Rated Movies"):
-            st.dataframe(
-                df_rating_merged.sort_values("avg_rating")
-                .reset_index(drop=True)
-                .shift()[1:]
-                .head(5)[["rating", "avg_rating", "liked", "title"]],
-                use_container_width=True,
-            )
-        with st.expander("Highest Rated Movies"):
-            st.dataframe(
-                df_rating_merged.sort_values("avg_rating", ascending=False)
-                .reset_index(drop=True)
-                .shift()[1:]
-                .head(5)[["rating", "avg_rating", "liked", "title"]],
-                use_container_width=True,
-            )
-
     st.write("")
 
     row_popularity = st.columns(2)
@@ -615,12 +506,163 @@ if submit:
                 use_container_width=True,
             )
 
+
+def render_rating_placeholders(
+    df_film, df_rating, rating_comparison, users_rating, rating_sections
+):
+    df_rating_merged = merge_film_ratings(df_film, df_rating)
+    with rating_comparison.container():
+        render_rating_comparison(df_rating_merged)
+    with users_rating.container():
+        render_users_rating(df_rating_merged)
+    with rating_sections.container():
+        render_rating_sections(df_rating_merged)
+
+
+current_dir = Path(__file__).parent if "__file__" in locals() else Path.cwd()
+css_file = current_dir / "styles" / "main.css"
+st.set_page_config(
+    page_icon="📽️",
+    page_title="Letterboxd Analysis",
+    layout="wide",
+)
+with open(css_file) as f:
+    st.markdown("<style>{}</style>".format(f.read()), unsafe_allow_html=True)
+
+st.title("📽️ Letterboxd Profile Analyzer")
+st.write(
+    "See how you rate your movies, what movies you like, the genres, the actors and directors of those movies 🍿."
+)
+
+username = st.text_input("Letterboxd Username")
+row_button = st.columns((6, 1, 1, 6))
+submit = row_button[1].button("Submit")
+
+
+if submit:
+    # scraping process
+    df_film = scrape_films(username)
+    df_film = df_film[df_film["rating"] != -1].reset_index(drop=True)
+    st.write("You have {0} movies to scrape".format(len(df_film)))
+    progress_area = st.container()
+
+    st.write("---")
+    st.markdown(
+        "<h1 style='text-align:center;'>👤 {0}'s Profile Analysis</h1>".format(
+            username
+        ),
+        unsafe_allow_html=True,
+    )
+    st.write("")
+    row_df = st.columns(3)
+    with row_df[0]:
+        st.markdown(
+            div(
+                style=styles(
+                    text_align="center",
+                    padding=(rem(1), 0, rem(2), 0),
+                )
+            )(
+                h2(style=styles(font_size=rem(2), padding=0))("👁️ Rated Movies"),
+                big(style=styles(font_size=rem(5), font_weight=600, line_height=1))(
+                    len(df_film)
+                ),
+            ),
+            unsafe_allow_html=True,
+        )
+    with row_df[1]:
+        st.markdown(
+            div(
+                style=styles(
+                    text_align="center",
+                    padding=(rem(1), 0, rem(2), 0),
+                )
+            )(
+                h2(style=styles(font_size=rem(2), padding=0))("❤️ Liked Movies"),
+                big(style=styles(font_size=rem(5), font_weight=600, line_height=1))(
+                    len(df_film[df_film["liked"] == True])
+                ),
+            ),
+            unsafe_allow_html=True,
+        )
+    with row_df[2]:
+        st.markdown(
+            div(
+                style=styles(
+                    text_align="center",
+                    padding=(rem(1), 0, rem(2), 0),
+                )
+            )(
+                h2(style=styles(font_size=rem(2), padding=0))("⭐ Average Ratings"),
+                big(style=styles(font_size=rem(5), font_weight=600, line_height=1))(
+                    round(df_film["rating"].mean(), 2)
+                ),
+            ),
+            unsafe_allow_html=True,
+        )
+
+    st.write("")
+    row_rating = st.columns(2)
+    with row_rating[0]:
+        st.subheader("How Do You Rate Your Movies?")
+        st.write("")
+        st.altair_chart(
+            alt.Chart(df_film.astype({"rating": str}))
+            .mark_bar(tooltip=True)
+            .encode(
+                alt.X("rating", axis=alt.Axis(labelAngle=0)),
+                y="count()",
+                color=alt.Color(
+                    "liked",
+                    scale=alt.Scale(domain=[True, False], range=["#ff8000", "#00b020"]),
+                ),
+            ),
+            use_container_width=True,
+        )
+        rating_comparison = st.empty()
+    with row_rating[1]:
+        st.subheader("How Do Letterboxd Users Rate Your Movies?")
+        st.write("")
+        users_rating = st.empty()
+    rating_sections = st.empty()
+
+    # the sections above only need the film list, the ones depending on film
+    # details are redrawn with every batch of films as they are scraped, a
+    # profile submitted again with the same films is served from the cache
+    details_cache = open_details_cache()
+    fingerprint = films_fingerprint(df_film, username)
+    details = details_cache.get(fingerprint)
+    if details is None:
+        films = pd.DataFrame()
+        with progress_area:
+            for batch in scrape_films_details(df_film, username):
+                films = concat_cached_and_scraped(films, batch)
+                details = build_films_details(films)
+                render_rating_placeholders(
+                    df_film,
+                    details[0],
+                    rating_comparison,
+                    users_rating,
+                    rating_sections,
+                )
+        if details is None:
+            # every film was dropped as unrated, there is nothing to analyze
+            st.write("{0} has no rated movies to analyze".format(username))
+            st.stop()
+        details_cache.put(fingerprint, details)
+    else:
+        render_rating_placeholders(
+            df_film, details[0], rating_comparison, users_rating, rating_sections
+        )
+    df_rating, df_actor, df_director, df_genre, df_theme, df_country, df_language = (
+        details
+    )
+
     df_director_merged = pd.merge(df_film, df_director, left_on="id", right_on="id")
     df_actor_merged = pd.merge(df_film, df_actor, left_on="id", right_on="id")
 
     df_temp = df_director["director"].value_counts().reset_index()
 
-    df_director_merged["rating"] = df_director_merged["rating"].astype(float)
     df_temp_2 = df_director_merged.groupby(["director", "director_link"]).agg(
         {"liked": "sum", "rating": "mean"}
     )
@@ -781,7 +823,6 @@ if submit:
         "weights"
     ].sum()
     df_temp = df_actor["actor"].value_counts().reset_index()
-    df_actor_merged["rating"] = df_actor_merged["rating"].astype(float)
     df_temp_2 = df_actor_merged.groupby(["actor", "actor_link"]).agg(
         {"liked": "sum", "rating": "mean"}
     )
@@ -937,8 +978,7 @@ if submit:
     df_genre_merged = pd.merge(df_film, df_genre, left_on="id", right_on="id")
     df_temp = df_genre["genre"].value_counts().reset_index()
     df_temp = df_temp[df_temp["count"] > df_film.shape[0] / 100].reset_index(drop=True)
-    df_genre_merged["rating"] = df_genre_merged["rating"].astype(float)
-    df_temp_2 = df_genre_merged.groupby(["genre"]).agg(
+    df_temp_2 = df_genre_merged.groupby(["genre"], observed=True).agg(
         {"liked": "sum", "rating": "mean"}
     )
     df_temp_2 = df_temp_2.reset_index()
@@ -1234,8 +1274,7 @@ if submit:
     df_theme_merged = pd.merge(df_film, df_theme, left_on="id", right_on="id")
 
     df_temp = df_theme["theme"].value_counts().reset_index()
-    df_theme_merged["rating"] = df_theme_merged["rating"].astype(float)
-    df_temp_2 = df_theme_merged.groupby(["theme"]).agg(
+    df_temp_2 = df_theme_merged.groupby(["theme"], observed=True).agg(
         {"liked": "sum", "rating": "mean"}
     )
     df_temp_2 = df_temp_2.reset_index()
@@ -1326,8 +1365,7 @@ if submit:
     df_country_merged = pd.merge(df_film, df_country, left_on="id", right_on="id")
 
     df_temp = df_country["country"].value_counts().reset_index()
-    df_country_merged["rating"] = df_country_merged["rating"].astype(float)
-    df_temp_2 = df_country_merged.groupby(["country"]).agg(
+    df_temp_2 = df_country_merged.groupby(["country"], observed=True).agg(
         {"liked": "sum", "rating": "mean"}
     )
     df_temp_2 = df_temp_2.reset_index()
@@ -1422,8 +1460,7 @@ if submit:
     df_language_merged = pd.merge(df_film, df_language, left_on="id", right_on="id")
 
     df_temp = df_language["language"].value_counts().reset_index()
-    df_language_merged["rating"] = df_language_merged["rating"].astype(float)
-    df_temp_2 = df_language_merged.groupby(["language"]).agg(
+    df_temp_2 = df_language_merged.groupby(["language"], observed=True).agg(
         {"liked": "sum", "rating": "mean"}
     )
     df_temp_2 = df_temp_2.reset_index()
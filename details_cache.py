@@ -0,0 +1,40 @@
+import threading
+import time
+from collections import OrderedDict
+
+# analysis frames of a profile are kept in memory this long, for this many
+# profiles, the least recently used profile is dropped first
+DETAILS_TTL = 60 * 60
+DETAILS_MAX_ENTRIES = 32
+
+
+class DetailsCache:
+    def __init__(
+        self, ttl: float = DETAILS_TTL, max_entries: int = DETAILS_MAX_ENTRIES
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, fingerprint: str) -> tuple:
+        with self.lock:
+            entry = self.entries.get(fingerprint)
+            if entry is None:
+                return None
+            stored_at, frames = entry
+            if time.time() - stored_at > self.ttl:
+                del self.entries[fingerprint]
+                return None
+            self.entries.move_to_end(fingerprint)
+
+        # callers add columns to the frames, the cached ones stay untouched
+        return tuple(frame.copy() for frame in frames)
+
+    def put(self, fingerprint: str, frames: tuple) -> None:
+        frames = tuple(frame.copy() for frame in frames)
+        with self.lock:
+            self.entries[fingerprint] = (time.time(), frames)
+            self.entries.move_to_end(fingerprint)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
@@ -0,0 +1,290 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import requests
+from lxml import etree, html
+
+import http_client
+from film_record_cache import FilmRecordCache
+from progress import log
+
+SHOW_ALL = "Show All…"
+
+# one film as stored in the films cache parquet
+FILM_RECORD_COLUMNS = [
+    "id",
+    "title",
+    "link",
+    "avg_rating",
+    "rating_count",
+    "year",
+    "watched_by",
+    "liked_by",
+    "runtime",
+    "actors",
+    "directors",
+    "genres",
+    "themes",
+    "countries",
+    "languages",
+]
+
+
+def parse_html(content: bytes):
+    # letterboxd serves utf-8, lxml parsers can't be shared between threads
+    return html.fromstring(content, parser=html.HTMLParser(encoding="utf-8"))
+
+
+def find_first(node, xpath: str):
+    found = node.xpath(xpath)
+    return found[0] if len(found) > 0 else None
+
+
+def find_links(node, skip_show_all: bool = True) -> list:
+    texts = []
+    for link in node.iter("a"):
+        text = link.text_content().strip()
+        if not skip_show_all or text != SHOW_ALL:
+            texts.append((text, link.get("href")))
+    return texts
+
+
+def section_links(section, heading: str) -> list:
+    # details sections are an <h3> heading followed by a <div> of links
+    for h3 in section.iter("h3"):
+        if heading in h3.text_content():
+            div = find_first(h3, "following-sibling::div[1]")
+            if div is not None:
+                return [text for text, _ in find_links(div)]
+    return []
+
+
+def parse_json_ld(root) -> dict:
+    script = find_first(root, '//script[@type="application/ld+json"]')
+    if script is None or script.text is None:
+        return {}
+
+    # the json is wrapped in /* <![CDATA[ */ ... /* ]]> */ comments
+    text = script.text
+    return json.loads(text[text.index("{") : text.rindex("}") + 1])
+
+
+def parse_film_page(content: bytes) -> dict:
+    # the page is parsed once with lxml, every section below is looked up once
+    root = parse_html(content)
+    film = {}
+
+    # rating and release year come from the structured data of the page
+    data = parse_json_ld(root)
+    rating = data.get("aggregateRating", {})
+    film["avg_rating"] = (
+        float(rating["ratingValue"]) if "ratingValue" in rating else np.nan
+    )
+    film["rating_count"] = int(rating.get("ratingCount", 0))
+    released = data.get("releasedEvent", [])
+    film["year"] = int(released[0]["startDate"][:4]) if len(released) > 0 else np.nan
+
+    try:
+        footer = find_first(root, '//p[@class="text-link text-footer"]')
+        film["runtime"] = int(footer.text_content().strip().split("\xa0")[0])
+    except:
+        film["runtime"] = np.nan
+
+    # finding the actors
+    film["actors"] = []
+    cast_list = find_first(
+        root,
+        '//div[contains(concat(" ", normalize-space(@class), " "), " cast-list ")]',
+    )
+    if cast_list is not None:
+        for actor, actor_link in find_links(cast_list):
+            film["actors"].append({"actor": actor, "actor_link": actor_link})
+
+    # finding the directors
+    film["directors"] = []
+    crew = find_first(root, '//div[@id="tab-crew"]//div')
+    if crew is not None:
+        for director, director_link in find_links(crew, skip_show_all=False):
+            film["directors"].append(
+                {"director": director, "director_link": director_link}
+            )
+
+    # finding the genres and themes
+    film["genres"] = []
+    film["themes"] = []
+    tab_genres = find_first(root, '//div[@id="tab-genres"]')
+    if tab_genres is not None:
+        divs = tab_genres.xpath(".//div")
+        if len(divs) > 0:
+            film["genres"] = [
+                text for text, _ in find_links(divs[0], skip_show_all=False)
+            ]
+        if len(divs) > 1 and "Themes" in etree.tostring(tab_genres, encoding="unicode"):
+            film["themes"] = [text for text, _ in find_links(divs[1])]
+
+    # finding the countries and languages
+    film["countries"] = []
+    film["languages"] = []
+    tab_details = find_first(root, '//div[@id="tab-details"]')
+    if tab_details is not None:
+        film["countries"] = section_links(tab_details, "Countr")
+        film["languages"] = section_links(tab_details, "Language")
+
+    return film
+
+
+def parse_film_stats(content: bytes) -> dict:
+    items = parse_html(content).xpath("//li")
+
+    def count(item) -> int:
+        title = find_first(item, ".//a").get("title")
+        return int(title.replace("\xa0", " ").split(" ")[2].replace(",", ""))
+
+    return {"watched_by": count(items[0]), "liked_by": count(items[2])}
+
+
+def build_film_record(film, movie_content: bytes, stats_content: bytes) -> dict:
+    details = parse_film_page(movie_content)
+    stats = parse_film_stats(stats_content)
+
+    return {
+        "id": film.id,
+        "title": film.title,
+        "link": film.link,
+        "avg_rating": details["avg_rating"],
+        "rating_count": details["rating_count"],
+        "year": details["year"],
+        "watched_by": stats["watched_by"],
+        "liked_by": stats["liked_by"],
+        "runtime": details["runtime"],
+        "actors": details["actors"],
+        "directors": details["directors"],
+        "genres": details["genres"],
+        "themes": details["themes"],
+        "countries": details["countries"],
+        "languages": details["languages"],
+    }
+
+
+def fetch_content(url: str, rate_limiter: http_client.HostRateLimiter) -> bytes:
+    response = http_client.get_with_retry(url, rate_limiter)
+    response.raise_for_status()
+    return response.content
+
+
+def scrape_film_records(
+    films: pd.DataFrame,
+    domain: str,
+    max_in_flight: int,
+    rate_limiter: http_client.HostRateLimiter,
+    record_cache: FilmRecordCache = None,
+):
+    # films with a fresh record in the cache are not requested at all, films
+    # whose static fields and rating are still fresh only need their stats fragment
+    cached_records = {}
+    stale_records = {}
+    if record_cache is not None:
+        for link in films["link"]:
+            record = record_cache.get(link)
+            if record is not None:
+                cached_records[link] = record
+                continue
+            record = record_cache.get_static(link)
+            if record is not None:
+                stale_records[link] = record
+
+    urls = []
+    for link in films["link"]:
+        if link in stale_records:
+            urls.append(domain + "/csi" + link + "stats")
+        elif link not in cached_records:
+            urls.append(domain + link)
+            urls.append(domain + "/csi" + link + "stats")
+
+    # film pages and stats fragments are fetched by the pool, records are
+    # built and yielded in the same order as films
+    executor = ThreadPoolExecutor(max_workers=max(1, max_in_flight))
+    try:
+        contents = executor.map(lambda url: fetch_content(url, rate_limiter), urls)
+        for film in films.itertuples(index=False):
+            if film.link in cached_records:
+                yield cached_records[film.link]
+            elif film.link in stale_records:
+                film_record = {
+                    **stale_records[film.link],
+                    **parse_film_stats(next(contents)),
+                }
+                record_cache.put_volatile(film_record)
+                yield film_record
+            else:
+                film_record = build_film_record(film, next(contents), next(contents))
+                if record_cache is not None:
+                    record_cache.put(film_record)
+                yield film_record
+    finally:
+        # a rerun closes the generator early, the queued requests are dropped
+        # instead of sent
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def scrape_film_stats(
+    films: pd.DataFrame,
+    domain: str,
+    max_in_flight: int,
+    rate_limiter: http_client.HostRateLimiter,
+):
+    urls = [domain + "/csi" + link + "stats" for link in films["link"]]
+
+    # only the small stats fragment, yielded in the same order as films
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+        yield from executor.map(lambda url: fetch_film_stats(url, rate_limiter), urls)
+
+
+def fetch_film_stats(url: str, rate_limiter: http_client.HostRateLimiter) -> dict:
+    # a film removed from the site, or still failing after the retries, gets
+    # None instead of ending the whole refresh
+    try:
+        return parse_film_stats(fetch_content(url, rate_limiter))
+    except requests.RequestException as error:
+        log(f"could not fetch {url} ({error})", "WARNING")
+        return None
+
+
+def explode_column(films: pd.DataFrame, column: str) -> pd.DataFrame:
+    exploded = films[["id", column]].explode(column, ignore_index=True)
+    # films with an empty list explode into a single NaN row
+    return exploded[exploded[column].notna()].reset_index(drop=True)
+
+
+def flatten_film_records(films: pd.DataFrame) -> tuple:
+    df_rating = films[
+        ["id", "avg_rating", "year", "watched_by", "liked_by", "runtime"]
+    ].reset_index(drop=True)
+    # older caches store rating and year as the strings scraped from the page
+    df_rating["avg_rating"] = pd.to_numeric(df_rating["avg_rating"], errors="coerce")
+    df_rating["year"] = pd.to_numeric(df_rating["year"], errors="coerce")
+
+    # actors and directors are lists of {name, link} structs
+    df_actor = explode_column(films, "actors")
+    df_actor = df_actor[["id"]].join(
+        pd.DataFrame(df_actor["actors"].tolist(), columns=["actor", "actor_link"])
+    )
+    df_director = explode_column(films, "directors")
+    df_director = df_director[["id"]].join(
+        pd.DataFrame(
+            df_director["directors"].tolist(), columns=["director", "director_link"]
+        )
+    )
+
+    df_genre = explode_column(films, "genres")
+    df_genre = df_genre.rename(columns={"genres": "genre"})
+    df_theme = explode_column(films, "themes")
+    df_theme = df_theme.rename(columns={"themes": "theme"})
+    df_country = explode_column(films, "countries")
+    df_country = df_country.rename(columns={"countries": "country"})
+    df_language = explode_column(films, "languages")
+    df_language = df_language.rename(columns={"languages": "language"})
+
+    return df_rating, df_actor, df_director, df_genre, df_theme, df_country, df_language
@@ -0,0 +1,118 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+# parsed film records of films missing from the films cache parquet
+CACHE_PATH = Path(__file__).parent / ".cache" / "film_records.sqlite"
+
+# counters change daily, the rating within days, cast, crew, genres and runtime
+# almost never; the stats page refreshes the counters only, an outdated rating
+# needs the whole film page
+VOLATILE_FIELDS = ["watched_by", "liked_by"]
+RATING_FIELDS = ["avg_rating", "rating_count"]
+VOLATILE_TTL = 24 * 60 * 60
+RATING_TTL = 7 * 24 * 60 * 60
+STATIC_TTL = 30 * 24 * 60 * 60
+
+
+class FilmRecordCache:
+    def __init__(
+        self,
+        path: Path = CACHE_PATH,
+        static_ttl: float = STATIC_TTL,
+        rating_ttl: float = RATING_TTL,
+        volatile_ttl: float = VOLATILE_TTL,
+    ):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.static_ttl = static_ttl
+        self.rating_ttl = rating_ttl
+        self.volatile_ttl = volatile_ttl
+
+        # one connection shared by all scraping threads, guarded by the lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS film_records (
+                    link TEXT PRIMARY KEY,
+                    static TEXT NOT NULL,
+                    static_fetched_at REAL NOT NULL,
+                    rating TEXT NOT NULL,
+                    rating_fetched_at REAL NOT NULL,
+                    volatile TEXT NOT NULL,
+                    volatile_fetched_at REAL NOT NULL
+                )
+                """)
+
+    def read(self, link: str) -> tuple:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT static, static_fetched_at, rating, rating_fetched_at, "
+                "volatile, volatile_fetched_at FROM film_records WHERE link = ?",
+                (link,),
+            ).fetchone()
+        if row is None:
+            return None, None
+
+        (
+            static,
+            static_fetched_at,
+            rating,
+            rating_fetched_at,
+            volatile,
+            volatile_fetched_at,
+        ) = row
+        now = time.time()
+        if (
+            now - static_fetched_at > self.static_ttl
+            or now - rating_fetched_at > self.rating_ttl
+        ):
+            return None, None
+
+        record = {**json.loads(static), **json.loads(rating), **json.loads(volatile)}
+        return record, now - volatile_fetched_at <= self.volatile_ttl
+
+    def get(self, link: str) -> dict:
+        record, volatile_fresh = self.read(link)
+        return record if volatile_fresh else None
+
+    def get_static(self, link: str) -> dict:
+        # the record with possibly outdated counters
+        record, _ = self.read(link)
+        return record
+
+    def put(self, record: dict) -> None:
+        static = {
+            field: value
+            for field, value in record.items()
+            if field not in VOLATILE_FIELDS + RATING_FIELDS
+        }
+        rating = {field: record[field] for field in RATING_FIELDS}
+        volatile = {field: record[field] for field in VOLATILE_FIELDS}
+        now = time.time()
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO film_records VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    record["link"],
+                    json.dumps(static),
+                    now,
+                    json.dumps(rating),
+                    now,
+                    json.dumps(volatile),
+                    now,
+                ),
+            )
+
+    def put_volatile(self, record: dict) -> None:
+        volatile = {field: record[field] for field in VOLATILE_FIELDS}
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE film_records SET volatile = ?, volatile_fetched_at = ? "
+                "WHERE link = ?",
+                (json.dumps(volatile), time.time(), record["link"]),
+            )
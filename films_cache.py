@@ -0,0 +1,193 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import requests
+
+import http_client
+
+CACHED_FILMS_URL = "https://drive.google.com/uc?id={file_id}"
+
+# local copies of the films cache, survive server restarts
+CACHE_DIR = Path(__file__).parent / ".cache"
+
+# films per row group of the written cache, smaller groups let readers skip
+# more of the file when looking up a few ids
+ROW_GROUP_SIZE = 10000
+
+# films scraped live by the app, merged on read with the downloaded cache
+DELTA_DIR = CACHE_DIR / "cached_films_delta"
+
+# number of delta files that triggers merging them into a single one
+DELTA_COMPACT_THRESHOLD = 20
+
+# seconds a live-scraped film is read from the delta, after that the app
+# scrapes it again through its record cache
+DELTA_MAX_AGE = 24 * 60 * 60
+
+delta_lock = threading.Lock()
+
+
+def write_atomically(path: Path, content: bytes) -> None:
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(content)
+    os.replace(tmp_path, path)
+
+
+def download_films_file(file_id: str, cache_dir: Path = CACHE_DIR) -> Path:
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    parquet_path = cache_dir / f"cached_films_{file_id}.parquet"
+    validators_path = cache_dir / f"cached_films_{file_id}.json"
+
+    headers = {}
+    if parquet_path.exists() and validators_path.exists():
+        validators = json.loads(validators_path.read_text())
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    url = CACHED_FILMS_URL.format(file_id=file_id)
+    print(f"public_url: {url}")
+
+    try:
+        response = http_client.get(url, headers=headers)
+        if response.status_code == 304:
+            print("cached films unchanged, using local copy")
+            return parquet_path
+        response.raise_for_status()
+    except requests.RequestException as error:
+        if parquet_path.exists():
+            print(f"could not revalidate cached films ({error}), using local copy")
+            return parquet_path
+        raise
+
+    write_atomically(parquet_path, response.content)
+    validators = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+    write_atomically(validators_path, json.dumps(validators).encode())
+    print(f"cached films downloaded to {parquet_path}")
+
+    return parquet_path
+
+
+def read_cached_films(dataset: ds.Dataset, ids=None, columns=None) -> pd.DataFrame:
+    # both the id filter and the projection are pushed down to the parquet
+    # reader, row groups whose id statistics don't match are skipped
+    film_filter = None
+    if ids is not None:
+        ids = pa.array(list(ids), type=dataset.schema.field("id").type)
+        film_filter = ds.field("id").isin(ids)
+    return dataset.to_table(columns=columns, filter=film_filter).to_pandas()
+
+
+def write_cached_films(
+    films_df: pd.DataFrame,
+    path: Path,
+    row_group_size: int = ROW_GROUP_SIZE,
+    partition_size: int = None,
+    use_dictionary: bool = True,
+) -> None:
+    # sorted ids give every row group a narrow id range in its statistics
+    films_df = films_df.sort_values("id", ignore_index=True)
+    table = pa.Table.from_pandas(films_df, preserve_index=False)
+
+    options = {
+        "row_group_size": row_group_size,
+        "write_statistics": True,
+        # names, links and titles repeat across films as much as genres do,
+        # every column is dictionary encoded unless turned off
+        "use_dictionary": use_dictionary,
+    }
+
+    if partition_size is None:
+        pq.write_table(table, path, **options)
+        return
+
+    # a directory with one file per id range, read back as a single dataset
+    path.mkdir(parents=True, exist_ok=True)
+    for i, start in enumerate(range(0, table.num_rows, partition_size)):
+        pq.write_table(
+            table.slice(start, partition_size),
+            path / f"part-{i:05d}.parquet",
+            **options,
+        )
+
+
+def delta_paths(delta_dir: Path) -> list:
+    # file names start with the write time, so later files sort last
+    return sorted(delta_dir.glob("delta-*.parquet"))
+
+
+def compact_delta(delta_dir: Path, max_age: float = DELTA_MAX_AGE) -> None:
+    paths = delta_paths(delta_dir)
+    films_df = pd.concat(
+        [pd.read_parquet(path, engine="pyarrow") for path in paths], ignore_index=True
+    )
+    films_df = films_df.drop_duplicates("id", keep="last")
+    # expired films would never be read again
+    films_df = films_df[films_df["scraped_at"] >= time.time() - max_age]
+    write_cached_films(films_df, delta_dir / f"delta-{time.time_ns()}.parquet")
+    for path in paths:
+        path.unlink()
+    print(f"compacted {len(paths)} delta files into one with {len(films_df)} films")
+
+
+def append_delta(films_df: pd.DataFrame, delta_dir: Path = DELTA_DIR) -> None:
+    delta_dir.mkdir(parents=True, exist_ok=True)
+    films_df = films_df.assign(scraped_at=time.time())
+    with delta_lock:
+        write_cached_films(films_df, delta_dir / f"delta-{time.time_ns()}.parquet")
+        if len(delta_paths(delta_dir)) >= DELTA_COMPACT_THRESHOLD:
+            compact_delta(delta_dir)
+
+
+def read_delta_films(
+    ids=None,
+    columns=None,
+    delta_dir: Path = DELTA_DIR,
+    max_age: float = DELTA_MAX_AGE,
+):
+    read_columns = None if columns is None else columns + ["scraped_at"]
+    with delta_lock:
+        parts = []
+        for path in delta_paths(delta_dir):
+            dataset = ds.dataset(path, format="parquet")
+            # files written before films were stamped count as expired
+            if "scraped_at" in dataset.schema.names:
+                parts.append(read_cached_films(dataset, ids, read_columns))
+
+    parts = [part[part["scraped_at"] >= time.time() - max_age] for part in parts]
+    parts = [part for part in parts if len(part) > 0]
+    if len(parts) == 0:
+        return None
+    delta_df = pd.concat(parts, ignore_index=True).drop_duplicates("id", keep="last")
+    return delta_df if columns is None else delta_df[columns]
+
+
+def merge_delta(films_df: pd.DataFrame, delta_df: pd.DataFrame) -> pd.DataFrame:
+    # the version of a film modified last wins, a base cache built after the
+    # film was scraped live replaces its delta version
+    if delta_df is None:
+        return films_df
+    delta_modified = dict(
+        zip(delta_df["id"], pd.to_datetime(delta_df["last_modified_date"]))
+    )
+    replaced = films_df["id"].map(delta_modified) >= pd.to_datetime(
+        films_df["last_modified_date"]
+    )
+    delta_df = delta_df[~delta_df["id"].isin(films_df[~replaced]["id"])]
+    films_df = films_df[~replaced]
+    if len(films_df) == 0:
+        return delta_df
+    if len(delta_df) == 0:
+        return films_df
+    return pd.concat([films_df, delta_df], ignore_index=True)
@@ -0,0 +1,268 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util import make_headers
+
+from progress import log
+
+# connections kept alive per host, keep it >= the number of scraping threads
+POOL_MAXSIZE = 16
+
+# seconds to wait for a connection and for the server to send data
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+# token bucket per host: sustained requests per second and allowed burst
+REQUESTS_PER_SECOND = 10
+RATE_LIMIT_BURST = 5
+
+# on a 429 the rate of the host is halved down to this floor, then every
+# successful request raises it by the step until it's back to the maximum
+MIN_REQUESTS_PER_SECOND = 0.5
+RATE_RECOVERY_STEP = 0.1
+
+# responses worth retrying, and how often and how long to back off
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+MAX_RETRIES = 5
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+
+class ConnectionStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.requests = 0
+
+    def add_opened(self) -> None:
+        with self.lock:
+            self.opened += 1
+
+    def add_request(self) -> None:
+        with self.lock:
+            self.requests += 1
+
+    @property
+    def reused(self) -> int:
+        return max(0, self.requests - self.opened)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.opened = 0
+            self.requests = 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.requests} requests, {self.opened} connections opened, "
+            f"{self.reused} reused"
+        )
+
+
+connection_stats = ConnectionStats()
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        connection_stats.add_opened()
+        return super()._new_conn()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        connection_stats.add_opened()
+        return super()._new_conn()
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def take(self) -> float:
+        # takes a token if there is one, otherwise returns how long to wait
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class HostRateLimiter:
+    def __init__(self, requests_per_second: float, burst: float = RATE_LIMIT_BURST):
+        self.max_rate = requests_per_second
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def bucket(self, url: str) -> TokenBucket:
+        host = urlparse(url).netloc
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.max_rate, self.burst)
+        return self.buckets[host]
+
+    def wait(self, url: str) -> None:
+        if not self.max_rate:
+            return
+        while True:
+            with self.lock:
+                delay = self.bucket(url).take()
+            if delay == 0:
+                return
+            time.sleep(delay)
+
+    def throttled(self, url: str) -> None:
+        # the server pushed back, halve the rate for that host
+        if not self.max_rate:
+            return
+        with self.lock:
+            bucket = self.bucket(url)
+            bucket.rate = max(MIN_REQUESTS_PER_SECOND, bucket.rate / 2)
+
+    def succeeded(self, url: str) -> None:
+        # and slowly climb back to the configured rate while it accepts requests
+        if not self.max_rate:
+            return
+        with self.lock:
+            bucket = self.bucket(url)
+            bucket.rate = min(self.max_rate, bucket.rate + RATE_RECOVERY_STEP)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.succeeded = 0
+        self.retried = 0
+        self.throttled = 0
+        self.failed = 0
+        self.bytes = 0
+
+    def add(self, field: str, value: int = 1) -> None:
+        with self.lock:
+            setattr(self, field, getattr(self, field) + value)
+
+    def __str__(self) -> str:
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        return (
+            f"{self.succeeded} succeeded ({self.succeeded / elapsed:.1f} req/s, "
+            f"{self.bytes / elapsed / 1024:.0f} KB/s), {self.retried} retried, "
+            f"{self.throttled} throttled, {self.failed} failed"
+        )
+
+
+request_metrics = RequestMetrics()
+
+# shared by every scraper of the process so concurrent users don't add up
+rate_limiter = HostRateLimiter(REQUESTS_PER_SECOND)
+
+
+def retry_after(response: requests.Response) -> float:
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff(attempt: int) -> float:
+    # exponential backoff with full jitter
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def create_session(pool_maxsize: int = POOL_MAXSIZE) -> requests.Session:
+    session = requests.Session()
+    adapter = CountingHTTPAdapter(
+        pool_connections=pool_maxsize, pool_maxsize=pool_maxsize
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    # gzip/deflate always, br only when a brotli decoder is installed
+    session.headers.update(make_headers(keep_alive=True, accept_encoding=True))
+    session.hooks["response"].append(
+        lambda response, *args, **kwargs: connection_stats.add_request()
+    )
+    return session
+
+
+def get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return get_session().get(url, **kwargs)
+
+
+def get_with_retry(
+    url: str,
+    limiter: HostRateLimiter = None,
+    max_retries: int = MAX_RETRIES,
+    **kwargs,
+) -> requests.Response:
+    limiter = limiter or rate_limiter
+
+    for attempt in range(max_retries + 1):
+        limiter.wait(url)
+        try:
+            response = get(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == max_retries:
+                request_metrics.add("failed")
+                raise
+            delay = backoff(attempt)
+        else:
+            if response.status_code not in RETRY_STATUSES:
+                limiter.succeeded(url)
+                request_metrics.add("succeeded")
+                request_metrics.add("bytes", len(response.content))
+                return response
+            if attempt == max_retries:
+                request_metrics.add("failed")
+                return response
+
+            if response.status_code == 429:
+                limiter.throttled(url)
+                request_metrics.add("throttled")
+            # a server asking for a longer wait can't hold a worker past the cap
+            delay = retry_after(response)
+            if delay is None:
+                delay = backoff(attempt)
+            delay = min(delay, BACKOFF_MAX)
+
+        request_metrics.add("retried")
+        log(f"retrying {url} in {delay:.1f}s (attempt {attempt + 1})", "WARNING")
+        time.sleep(delay)
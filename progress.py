@@ -0,0 +1,54 @@
+import os
+import threading
+import time
+
+# lines below this level are not printed, DEBUG adds a line per scraped film
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30}
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+# seconds between two progress updates, the ones in between are dropped
+PROGRESS_INTERVAL = 0.5
+
+
+def log(message: str, level: str = "INFO") -> None:
+    if LOG_LEVELS[level] >= LOG_LEVELS.get(LOG_LEVEL, LOG_LEVELS["INFO"]):
+        print(message)
+
+
+class ProgressReporter:
+    def __init__(
+        self,
+        total: int,
+        label: str,
+        on_update=None,
+        interval: float = PROGRESS_INTERVAL,
+    ):
+        # on_update gets the done fraction, e.g. the progress method of a
+        # streamlit progress bar, the script only logs
+        self.total = total
+        self.label = label
+        self.on_update = on_update
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.done = 0
+        self.reported_at = None
+
+    def advance(self, count: int = 1, message: str = None) -> None:
+        if message is not None:
+            log(message, "DEBUG")
+
+        with self.lock:
+            self.done += count
+            now = time.monotonic()
+            finished = self.done >= self.total
+            if (
+                not finished
+                and self.reported_at is not None
+                and now - self.reported_at < self.interval
+            ):
+                return
+            self.reported_at = now
+
+            log(f"{self.label}: {self.done}/{self.total}")
+            if self.on_update is not None:
+                self.on_update(min(1.0, self.done / self.total) if self.total else 1.0)
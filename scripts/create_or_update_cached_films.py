@@ -1,14 +1,55 @@
-import numpy as np
+import argparse
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
-import requests
 from bs4 import BeautifulSoup
-from datetime import date
+from datetime import date, timedelta
+from pathlib import Path
 
 from pandas import DataFrame
 
+# the script runs from scripts/, make the app modules importable
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import film_parser
+import films_cache
+import http_client
+from progress import ProgressReporter, log
+
 DOMAIN = "https://letterboxd.com"
 USERNAMES = []  # add usernames prior to run the script
 
+# films cached longer than this many days ago are scraped again, None keeps them
+STALE_AFTER_DAYS = None
+
+# number of users whose film lists are fetched at the same time
+USERS_CONCURRENCY = 4
+
+# number of threads scraping film details, each takes DETAILS_CHUNK_SIZE films
+# at a time and checkpoints them once they are done
+DETAILS_MAX_WORKERS = 8
+DETAILS_CHUNK_SIZE = 25
+
+# max number of requests per second sent to Letterboxd, shared by all threads
+REQUESTS_PER_SECOND = 10
+
+# seconds between two progress lines of the details and stats loops
+PROGRESS_INTERVAL = 10
+
+# work queue and finished chunks of the current run, one parquet per chunk
+CHECKPOINT_DIR = Path("cached_films_checkpoint")
+
+# films per id-range file, when set the snapshot is written as a directory
+PARTITION_SIZE = None
+
+rate_limiter = http_client.HostRateLimiter(REQUESTS_PER_SECOND)
+
+
+def get(url: str):
+    return http_client.get_with_retry(url, rate_limiter)
+
 
 def transform_ratings(start_str: str) -> float:
     stars = {
@@ -35,7 +76,7 @@ def decade_year(year: int) -> str:
 
 
 def scrape_films(username):
-    print("==== SCRAPING FOR USERNAME {} ====".format(username))
+    log("==== SCRAPING FOR USERNAME {} ====".format(username))
     movies_dict = {}
     movies_dict["id"] = []
     movies_dict["title"] = []
@@ -43,9 +84,8 @@ def scrape_films(username):
     movies_dict["liked"] = []
     movies_dict["link"] = []
     url = DOMAIN + "/" + username + "/films/"
-    url_page = requests.get(url)
-    if url_page.status_code != 200:
-        raise Exception()
+    url_page = get(url)
+    url_page.raise_for_status()
     soup = BeautifulSoup(url_page.content, "html.parser")
 
     # check number of pages
@@ -71,9 +111,8 @@ def scrape_films(username):
     else:
         for i in range(int(li_pagination[-1].find("a").get_text().strip())):
             url = DOMAIN + "/" + username + "/films/page/" + str(i + 1)
-            url_page = requests.get(url)
-            if url_page.status_code != 200:
-                raise Exception()
+            url_page = get(url)
+            url_page.raise_for_status()
             soup = BeautifulSoup(url_page.content, "html.parser")
             ul = soup.find("ul", {"class": "poster-list"})
             if ul != None:
@@ -96,211 +135,246 @@ def scrape_films(username):
     return pd.DataFrame(movies_dict)
 
 
-def scrape_films_details(df_film):
+def scrape_films_details(df_film, progress: ProgressReporter):
     df_film = df_film[df_film["rating"] != -1].reset_index(drop=True)
-    movies_data = {}
-    movies_data["id"] = []
-    movies_data["title"] = []
-    movies_data["link"] = []
-    movies_data["avg_rating"] = []
-    movies_data["year"] = []
-    movies_data["watched_by"] = []
-    movies_data["liked_by"] = []
-    movies_data["runtime"] = []
-
-    movies_data["actors"] = []
 
-    movies_data["directors"] = []
-
-    movies_data["genres"] = []
-
-    movies_data["themes"] = []
-
-    movies_data["countries"] = []
-
-    movies_data["languages"] = []
-
-    for link in df_film["link"]:
-        print(
-            "scraping details of {}".format(
-                df_film[df_film["link"] == link]["title"].values[0]
+    # chunks are already scraped in parallel, one request at a time per chunk
+    film_records = []
+    for film_record in film_parser.scrape_film_records(
+        df_film, DOMAIN, 1, rate_limiter
+    ):
+        progress.advance(message="scraping details of {}".format(film_record["title"]))
+        film_records.append(film_record)
+
+    return pd.DataFrame(film_records, columns=film_parser.FILM_RECORD_COLUMNS)
+
+
+def scrape_films_details_chunk(df_film: DataFrame, progress: ProgressReporter) -> None:
+    chunk_df = scrape_films_details(df_film, progress)
+    # chunks are named after their first film, which no other chunk contains,
+    # and written atomically so a killed run never leaves a truncated chunk
+    films_cache.write_atomically(
+        CHECKPOINT_DIR / f"part-{df_film['id'].iloc[0]}.parquet",
+        chunk_df.to_parquet(engine="pyarrow"),
+    )
+
+
+def scrape_films_details_parallel(df_film: DataFrame) -> None:
+    chunks = [
+        df_film.iloc[i : i + DETAILS_CHUNK_SIZE]
+        for i in range(0, len(df_film), DETAILS_CHUNK_SIZE)
+    ]
+
+    progress = ProgressReporter(
+        len(df_film), "film details", interval=PROGRESS_INTERVAL
+    )
+
+    # every film is scraped by exactly one worker, and every finished chunk is
+    # checkpointed right away
+    with ThreadPoolExecutor(max_workers=DETAILS_MAX_WORKERS) as executor:
+        list(
+            executor.map(
+                lambda chunk: scrape_films_details_chunk(chunk, progress), chunks
             )
         )
 
-        id_movie = df_film[df_film["link"] == link]["id"].values[0]
-        url_movie = DOMAIN + link
-        url_movie_page = requests.get(url_movie)
-        if url_movie_page.status_code != 200:
-            raise Exception()
-        soup_movie = BeautifulSoup(url_movie_page.content, "html.parser")
-        for sc in soup_movie.findAll("script"):
-            if sc.string != None:
-                if "ratingValue" in sc.string:
-                    rating = sc.string.split("ratingValue")[1].split(",")[0][2:]
-                if "releaseYear" in sc.string:
-                    year = (
-                        sc.string.split("releaseYear")[1]
-                        .split(",")[0][2:]
-                        .replace('"', "")
-                    )
-        url_stats = DOMAIN + "/csi" + link + "stats"
-        url_stats_page = requests.get(url_stats)
-        soup_stats = BeautifulSoup(url_stats_page.content, "html.parser")
-        watched_by = int(
-            soup_stats.findAll("li")[0]
-            .find("a")["title"]
-            .replace("\xa0", " ")
-            .split(" ")[2]
-            .replace(",", "")
-        )
-        liked_by = int(
-            soup_stats.findAll("li")[2]
-            .find("a")["title"]
-            .replace("\xa0", " ")
-            .split(" ")[2]
-            .replace(",", "")
-        )
-        try:
-            runtime = int(
-                soup_movie.find("p", {"class": "text-link text-footer"})
-                .get_text()
-                .strip()
-                .split("\xa0")[0]
-            )
-        except:
-            runtime = np.nan
-        movies_data["id"].append(id_movie)
-        movies_data["title"].append(df_film[df_film["link"] == link]["title"].values[0])
-        movies_data["link"].append(link)
-        movies_data["avg_rating"].append(rating)
-        movies_data["year"].append(year)
-        movies_data["watched_by"].append(watched_by)
-        movies_data["liked_by"].append(liked_by)
-        movies_data["runtime"].append(runtime)
-
-        # finding the actors
-        if soup_movie.find("div", {"class": "cast-list"}) != None:
-            actors = []
-            for actor in soup_movie.find("div", {"class": "cast-list"}).findAll("a"):
-                if actor.get_text().strip() != "Show All…":
-                    actor_data = {
-                        "actor": actor.get_text().strip(),
-                        "actor_link": actor["href"],
-                    }
-                    actors.append(actor_data)
-
-            movies_data["actors"].append(actors)
-        else:
-            movies_data["actors"].append([])
-
-        # finding the directors
-        if soup_movie.find("div", {"id": "tab-crew"}) != None:
-            directors = []
-            for director in (
-                soup_movie.find("div", {"id": "tab-crew"}).find("div").findAll("a")
-            ):
-                director_data = {
-                    "director": director.get_text().strip(),
-                    "director_link": director["href"],
-                }
-                directors.append(director_data)
-
-            movies_data["directors"].append(directors)
-        else:
-            movies_data["directors"].append([])
-
-        # finding the genres
-        if soup_movie.find("div", {"id": "tab-genres"}) != None:
-            genres = []
-            for genre in (
-                soup_movie.find("div", {"id": "tab-genres"}).find("div").findAll("a")
-            ):
-                genres.append(genre.get_text().strip())
-
-            movies_data["genres"].append(genres)
-        else:
-            movies_data["genres"].append([])
-
-        # finding the themes
-        if soup_movie.find("div", {"id": "tab-genres"}) != None:
-            if "Themes" in str(soup_movie.find("div", {"id": "tab-genres"})):
-                themes = []
-                for theme in (
-                    soup_movie.find("div", {"id": "tab-genres"})
-                    .findAll("div")[1]
-                    .findAll("a")
-                ):
-                    if theme.get_text().strip() != "Show All…":
-                        themes.append(theme.get_text().strip())
-
-                movies_data["themes"].append(themes)
-            else:
-                movies_data["themes"].append([])
-        else:
-            movies_data["themes"].append([])
-
-        # finding the countries
-        if soup_movie.find("div", {"id": "tab-details"}) != None:
-            if "Countr" in str(soup_movie.find("div", {"id": "tab-details"})):
-                countries = []
-                for country in (
-                    soup_movie.find("div", {"id": "tab-details"})
-                    .find("h3", string=lambda text: text and "Countr" in text)
-                    .find_next_sibling("div")
-                    .findAll("a")
-                ):
-                    if country.get_text().strip() != "Show All…":
-                        countries.append(country.get_text().strip())
-
-                movies_data["countries"].append(countries)
-            else:
-                movies_data["countries"].append([])
-        else:
-            movies_data["countries"].append([])
-
-        # finding the languages
-        if soup_movie.find("div", {"id": "tab-details"}) != None:
-            if "Language" in str(soup_movie.find("div", {"id": "tab-details"})):
-                languages = []
-                for language in (
-                    soup_movie.find("div", {"id": "tab-details"})
-                    .find("h3", string=lambda text: text and "Language" in text)
-                    .find_next_sibling("div")
-                    .findAll("a")
-                ):
-                    if language.get_text().strip() != "Show All…":
-                        languages.append(language.get_text().strip())
-
-                movies_data["languages"].append(languages)
-            else:
-                movies_data["languages"].append([])
-        else:
-            movies_data["languages"].append([])
-
-    return pd.DataFrame(movies_data)
-
-
-today = date.today()
-
-final_df: DataFrame = None
-
-for username in USERNAMES:
-    if final_df is None:
-        films_df = scrape_films(username)
-        final_df = scrape_films_details(films_df)
+
+def save_checkpoint_queue(queue_df: DataFrame) -> None:
+    if CHECKPOINT_DIR.exists():
+        print(f"discarding previous checkpoint in {CHECKPOINT_DIR}")
+        shutil.rmtree(CHECKPOINT_DIR)
+    CHECKPOINT_DIR.mkdir(parents=True)
+    films_cache.write_atomically(
+        CHECKPOINT_DIR / "queue.parquet", queue_df.to_parquet(engine="pyarrow")
+    )
+
+
+def load_checkpoint_queue() -> DataFrame:
+    queue_path = CHECKPOINT_DIR / "queue.parquet"
+    if not queue_path.exists():
+        return None
+    return pd.read_parquet(queue_path, engine="pyarrow")
+
+
+def load_checkpointed_films() -> DataFrame:
+    # fragments are read one by one, their dtypes may differ (e.g. runtime)
+    parts = [
+        pd.read_parquet(path, engine="pyarrow")
+        for path in sorted(CHECKPOINT_DIR.glob("part-*.parquet"))
+    ]
+    if len(parts) == 0:
+        return None
+    return pd.concat(parts, ignore_index=True)
+
+
+def load_latest_cached_films() -> DataFrame:
+    # snapshots are named cached_films_<yy-mm-dd>.parquet, so names sort by date
+    paths = sorted(Path.cwd().glob("cached_films_*.parquet"))
+    if len(paths) == 0:
+        print("no previous cache found, building from scratch")
+        return None
+
+    print(f"loading previous cache {paths[-1].name}")
+    previous_df = pd.read_parquet(paths[-1], engine="pyarrow")
+
+    # older snapshots store rating and year as the strings scraped from the page
+    previous_df["avg_rating"] = pd.to_numeric(
+        previous_df["avg_rating"], errors="coerce"
+    )
+    previous_df["year"] = pd.to_numeric(previous_df["year"], errors="coerce")
+    return previous_df
+
+
+def fresh_film_ids(previous_df: DataFrame, today: date) -> set:
+    if previous_df is None:
+        return set()
+
+    if STALE_AFTER_DAYS is None:
+        return set(previous_df["id"])
+
+    last_modified = pd.to_datetime(previous_df["last_modified_date"])
+    threshold = pd.Timestamp(today - timedelta(days=STALE_AFTER_DAYS))
+    return set(previous_df[last_modified >= threshold]["id"])
+
+
+def build_work_queue(previous_df: DataFrame, today: date) -> DataFrame:
+    known_ids = fresh_film_ids(previous_df, today)
+    skipped_ids = set()
+
+    # film lists of all users are fetched concurrently and unioned into one
+    # de-duplicated work queue, so films watched by many users are scraped once
+    queued_ids = set()
+    chunks = []
+
+    with ThreadPoolExecutor(max_workers=USERS_CONCURRENCY) as executor:
+        for films_df in executor.map(scrape_films, USERNAMES):
+            films_df = films_df[films_df["rating"] != -1]
+            is_known = films_df["id"].isin(known_ids)
+            skipped_ids.update(films_df[is_known]["id"])
+            films_df = films_df[~is_known]
+            if len(films_df) == 0:
+                continue
+
+            films_df = films_df[~films_df["id"].isin(queued_ids)]
+            films_df = films_df.drop_duplicates("id")
+            queued_ids.update(films_df["id"])
+            chunks.append(films_df)
+
+    print(
+        f"{len(skipped_ids)} films skipped (already cached), "
+        f"{len(queued_ids)} films queued"
+    )
+
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=["id", "title", "rating", "liked", "link"])
+    return pd.concat(chunks, ignore_index=True)
+
+
+def refresh_film_stats(previous_df: DataFrame) -> DataFrame:
+    progress = ProgressReporter(
+        len(previous_df), "film stats", interval=PROGRESS_INTERVAL
+    )
+    stats = []
+    failed = 0
+    for film_stats in film_parser.scrape_film_stats(
+        previous_df, DOMAIN, DETAILS_MAX_WORKERS, rate_limiter
+    ):
+        progress.advance()
+        if film_stats is None:
+            failed += 1
+            film_stats = {}
+        stats.append(film_stats)
+    if failed > 0:
+        print(f"{failed} films could not be refreshed, keeping their previous stats")
+
+    # static fields are kept, only the counters of the stats fragment change
+    counters = previous_df[["watched_by", "liked_by"]]
+    stats_df = pd.DataFrame(stats, index=previous_df.index, columns=counters.columns)
+    refreshed_df = previous_df.copy()
+    refreshed_df[counters.columns] = stats_df.fillna(counters).astype(counters.dtypes)
+    return refreshed_df
+
+
+def save_snapshot(final_df: DataFrame, today: date) -> None:
+    films_cache.write_cached_films(
+        final_df,
+        Path(f"cached_films_{today.strftime('%y-%m-%d')}.parquet"),
+        partition_size=PARTITION_SIZE,
+    )
+
+    log(f"http connections: {http_client.connection_stats}")
+    log(f"http requests: {http_client.request_metrics}")
+    print(f"DataFrame saved to cached_films_{today.strftime('%y-%m-%d')}.parquet")
+
+
+def main(resume: bool = False, refresh_stats: bool = False):
+    today = date.today()
+
+    previous_df = load_latest_cached_films()
+
+    if refresh_stats:
+        if previous_df is None:
+            print("no previous cache found, nothing to refresh")
+            return
+
+        print(f"refreshing stats of {len(previous_df)} films")
+        save_snapshot(refresh_film_stats(previous_df), today)
+        return
+
+    if resume:
+        queue_df = load_checkpoint_queue()
+        if queue_df is None:
+            print(f"no checkpoint found in {CHECKPOINT_DIR}, nothing to resume")
+            return
     else:
-        new_films_df = scrape_films(username)
-        new_films_df = new_films_df[~new_films_df["id"].isin(final_df["id"])]
-        new_final_df = scrape_films_details(new_films_df)
-        new_final_df = new_final_df[~new_final_df["id"].isin(final_df["id"])]
+        queue_df = build_work_queue(previous_df, today)
+        save_checkpoint_queue(queue_df)
+
+    done_df = load_checkpointed_films()
+    if done_df is not None:
+        queue_df = queue_df[~queue_df["id"].isin(done_df["id"])]
+        print(f"{len(done_df)} films restored from checkpoint")
 
-        final_df = pd.concat([final_df, new_final_df], ignore_index=True)
+    print(f"{len(queue_df)} films to fetch")
+    if len(queue_df) > 0:
+        scrape_films_details_parallel(queue_df)
 
+    final_df = load_checkpointed_films()
 
-final_df["last_modified_date"] = today
+    if final_df is not None:
+        final_df["last_modified_date"] = today
 
-final_df.to_parquet(
-    f"cached_films_{today.strftime('%y-%m-%d')}.parquet", engine="pyarrow"
-)
+    # re-scraped films replace their previous version in the new snapshot
+    if previous_df is not None:
+        if final_df is not None:
+            previous_df = previous_df[~previous_df["id"].isin(final_df["id"])]
+        final_df = pd.concat([previous_df, final_df], ignore_index=True)
 
-print(f"DataFrame saved to cached_films_{today.strftime('%y-%m-%d')}.parquet")
+    if final_df is None:
+        print("nothing to save")
+        shutil.rmtree(CHECKPOINT_DIR)
+        return
+
+    save_snapshot(final_df, today)
+
+    # the snapshot holds everything now, the checkpoint is not needed anymore
+    shutil.rmtree(CHECKPOINT_DIR)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Create or update the cached films parquet"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue the last interrupted run from its checkpoint",
+    )
+    parser.add_argument(
+        "--refresh-stats",
+        action="store_true",
+        help="only refresh watched_by and liked_by of the films in the latest cache",
+    )
+    args = parser.parse_args()
+
+    main(args.resume, args.refresh_stats)
@@ -0,0 +1,88 @@
+import math
+import re
+import sys
+from pathlib import Path
+
+# the tests run from the repository root, make the app modules importable
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import film_parser
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+
+FILM_PAGE = (FIXTURES_DIR / "film_page.html").read_text(encoding="utf-8")
+FILM_STATS = (FIXTURES_DIR / "film_stats.html").read_text(encoding="utf-8")
+
+THEMES_SECTION = re.compile(r"<h3><span>Themes</span></h3>\s*<div.*?</div>", re.S)
+RUNTIME_FOOTER = re.compile(r'<p class="text-link text-footer">.*?</p>', re.S)
+AGGREGATE_RATING = re.compile(r',"aggregateRating":\{.*?\}')
+
+
+def parse(page: str) -> dict:
+    return film_parser.parse_film_page(page.encode("utf-8"))
+
+
+def test_parse_json_ld():
+    data = film_parser.parse_json_ld(film_parser.parse_html(FILM_PAGE.encode()))
+
+    assert data["name"] == "Amélie"
+    assert data["aggregateRating"]["ratingValue"] == 4.04
+    assert data["releasedEvent"][0]["startDate"] == "2001"
+
+
+def test_parse_json_ld_without_script():
+    root = film_parser.parse_html(b"<html><body></body></html>")
+
+    assert film_parser.parse_json_ld(root) == {}
+
+
+def test_parse_film_page():
+    film = parse(FILM_PAGE)
+
+    assert film["avg_rating"] == 4.04
+    assert film["rating_count"] == 1421537
+    assert film["year"] == 2001
+    assert film["runtime"] == 122
+    assert film["actors"] == [
+        {"actor": "Audrey Tautou", "actor_link": "/actor/audrey-tautou/"},
+        {"actor": "Mathieu Kassovitz", "actor_link": "/actor/mathieu-kassovitz/"},
+        {"actor": "Rufus", "actor_link": "/actor/rufus/"},
+    ]
+    assert film["directors"] == [
+        {
+            "director": "Jean-Pierre Jeunet",
+            "director_link": "/director/jean-pierre-jeunet/",
+        }
+    ]
+    assert film["genres"] == ["Comedy", "Romance"]
+    assert film["themes"] == ["Quirky and charming", "Passion and romance"]
+    assert film["countries"] == ["France", "Germany"]
+    assert film["languages"] == ["French"]
+
+
+def test_parse_film_page_without_themes():
+    film = parse(THEMES_SECTION.sub("", FILM_PAGE))
+
+    assert film["genres"] == ["Comedy", "Romance"]
+    assert film["themes"] == []
+
+
+def test_parse_film_page_without_runtime():
+    film = parse(RUNTIME_FOOTER.sub("", FILM_PAGE))
+
+    assert math.isnan(film["runtime"])
+    assert film["year"] == 2001
+
+
+def test_parse_film_page_without_rating():
+    film = parse(AGGREGATE_RATING.sub("", FILM_PAGE))
+
+    assert math.isnan(film["avg_rating"])
+    assert film["rating_count"] == 0
+    assert film["year"] == 2001
+
+
+def test_parse_film_stats():
+    stats = film_parser.parse_film_stats(FILM_STATS.encode("utf-8"))
+
+    assert stats == {"watched_by": 2084310, "liked_by": 701945}
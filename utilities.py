@@ -1,28 +1,103 @@
-import io
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 
 from bs4 import BeautifulSoup
-import requests
 import pandas as pd
 import numpy as np
 import streamlit as st
+import pyarrow.dataset as ds
 from pandas import DataFrame
 
+import film_parser
+import films_cache
+import http_client
+from details_cache import DetailsCache
+from film_record_cache import FilmRecordCache
+from progress import ProgressReporter, log
+
 DOMAIN = "https://letterboxd.com"
 
+# max number of film list pages fetched at the same time
+PAGES_CONCURRENCY = 8
+
+# max number of film detail requests (film pages and stats) in flight at once
+DETAILS_MAX_IN_FLIGHT = 8
+
+# scraped films handed to the dashboard at a time while the rest is scraped
+DETAILS_BATCH_SIZE = 100
+
+# seconds the downloaded films cache is kept in memory before downloading again
+CACHED_FILMS_TTL = 6 * 60 * 60
+
+# dtypes of the film list and of the rating frame, applied once when they are
+# built so merges and groupbys run on compact numeric arrays
+FILM_DTYPES = {"id": "int32", "rating": "float64", "liked": "bool"}
+RATING_DTYPES = {
+    "id": "int32",
+    "avg_rating": "float64",
+    "year": "Int16",
+    "watched_by": "int32",
+    "liked_by": "int32",
+    "runtime": "Int16",
+}
+
+# columns of the films cache used to build the analysis frames
+CACHED_FILMS_COLUMNS = [
+    "id",
+    "avg_rating",
+    "year",
+    "watched_by",
+    "liked_by",
+    "runtime",
+    "actors",
+    "directors",
+    "genres",
+    "themes",
+    "countries",
+    "languages",
+]
+
+
+@st.cache_resource(ttl=CACHED_FILMS_TTL, show_spinner=False)
+def open_cached_films(file_id: str) -> ds.Dataset:
+    # only the file metadata is loaded here, rows are read per user
+    parquet_path = films_cache.download_films_file(file_id)
+    return ds.dataset(parquet_path, format="parquet")
 
-def fetch_cached_films_as_dataframe():
-    file_id = st.secrets["FILMS_FILE_ID"]
-    public_url = f"https://drive.google.com/uc?id={file_id}"
 
-    print(f"public_url: {public_url}")
+def fetch_cached_films_as_dataframe(
+    ids=None, columns=None, delta_max_age: float = films_cache.DELTA_MAX_AGE
+) -> DataFrame:
+    dataset = open_cached_films(st.secrets["FILMS_FILE_ID"])
+    # the modification date decides between the base and the delta version
+    read_columns = None if columns is None else columns + ["last_modified_date"]
+    films_df = films_cache.read_cached_films(dataset, ids, read_columns)
+    delta_df = films_cache.read_delta_films(ids, read_columns, max_age=delta_max_age)
+    films_df = films_cache.merge_delta(films_df, delta_df)
+    return films_df if columns is None else films_df[columns]
 
-    # Download the file into memory
-    response = requests.get(public_url)
-    response.raise_for_status()  # Ensure the request was successful
 
-    # Load Parquet file into a Pandas DataFrame
-    parquet_file = io.BytesIO(response.content)
-    return pd.read_parquet(parquet_file, engine="pyarrow")
+def invalidate_cached_films() -> None:
+    open_cached_films.clear()
+
+
+@st.cache_resource(show_spinner=False)
+def open_film_record_cache() -> FilmRecordCache:
+    return FilmRecordCache()
+
+
+@st.cache_resource(show_spinner=False)
+def open_details_cache() -> DetailsCache:
+    # shared by all sessions, a profile submitted again is not scraped again
+    return DetailsCache()
+
+
+def films_fingerprint(df_film: DataFrame, username: str) -> str:
+    # only ids and ratings of the film list are hashed, not the whole frame
+    films = df_film[["id", "rating"]].sort_values("id")
+    hashed = pd.util.hash_pandas_object(films, index=False)
+    return hashlib.sha1(username.encode() + hashed.values.tobytes()).hexdigest()
 
 
 def transform_ratings(start_str: str) -> float:
@@ -45,9 +120,31 @@ def transform_ratings(start_str: str) -> float:
         return -1
 
 
+def parse_films_page(soup: BeautifulSoup, movies_dict: dict) -> None:
+    ul = soup.find("ul", {"class": "poster-list"})
+    if ul != None:
+        movies = ul.find_all("li")
+        for movie in movies:
+            movies_dict["id"].append(movie.find("div")["data-film-id"])
+            movies_dict["title"].append(movie.find("img")["alt"])
+            movies_dict["rating"].append(
+                transform_ratings(
+                    movie.find("p", {"class": "poster-viewingdata"}).get_text().strip()
+                )
+            )
+            movies_dict["liked"].append(movie.find("span", {"class": "like"}) != None)
+            movies_dict["link"].append(movie.find("div")["data-target-link"])
+
+
+def fetch_page(url: str) -> bytes:
+    url_page = http_client.get_with_retry(url)
+    url_page.raise_for_status()
+    return url_page.content
+
+
 @st.cache_data
-def scrape_films(username):
-    print("==== SCRAPING FOR USERNAME {} ====".format(username))
+def scrape_films(username, concurrency: int = PAGES_CONCURRENCY):
+    log("==== SCRAPING FOR USERNAME {} ====".format(username))
     movies_dict = {}
     movies_dict["id"] = []
     movies_dict["title"] = []
@@ -55,60 +152,27 @@ def scrape_films(username):
     movies_dict["liked"] = []
     movies_dict["link"] = []
     url = DOMAIN + "/" + username + "/films/"
-    url_page = requests.get(url)
-    if url_page.status_code != 200:
-        encounter_error("")
-    soup = BeautifulSoup(url_page.content, "html.parser")
+    soup = BeautifulSoup(fetch_page(url), "html.parser")
+
+    # first page is already in hand, it tells us the number of pages
+    parse_films_page(soup, movies_dict)
 
-    # check number of pages
     li_pagination = soup.findAll("li", {"class": "paginate-page"})
-    if len(li_pagination) == 0:
-        ul = soup.find("ul", {"class": "poster-list"})
-        if ul != None:
-            movies = ul.find_all("li")
-            for movie in movies:
-                movies_dict["id"].append(movie.find("div")["data-film-id"])
-                movies_dict["title"].append(movie.find("img")["alt"])
-                movies_dict["rating"].append(
-                    transform_ratings(
-                        movie.find("p", {"class": "poster-viewingdata"})
-                        .get_text()
-                        .strip()
-                    )
-                )
-                movies_dict["liked"].append(
-                    movie.find("span", {"class": "like"}) != None
-                )
-                movies_dict["link"].append(movie.find("div")["data-target-link"])
-    else:
-        for i in range(int(li_pagination[-1].find("a").get_text().strip())):
-            url = DOMAIN + "/" + username + "/films/page/" + str(i + 1)
-            url_page = requests.get(url)
-            if url_page.status_code != 200:
-                encounter_error("")
-            soup = BeautifulSoup(url_page.content, "html.parser")
-            ul = soup.find("ul", {"class": "poster-list"})
-            if ul != None:
-                movies = ul.find_all("li")
-                for movie in movies:
-                    movies_dict["id"].append(movie.find("div")["data-film-id"])
-                    movies_dict["title"].append(movie.find("img")["alt"])
-                    movies_dict["rating"].append(
-                        transform_ratings(
-                            movie.find("p", {"class": "poster-viewingdata"})
-                            .get_text()
-                            .strip()
-                        )
-                    )
-                    movies_dict["liked"].append(
-                        movie.find("span", {"class": "like"}) != None
-                    )
-                    movies_dict["link"].append(movie.find("div")["data-target-link"])
-
-    return pd.DataFrame(movies_dict)
+    if len(li_pagination) > 0:
+        num_of_pages = int(li_pagination[-1].find("a").get_text().strip())
+        urls = [
+            DOMAIN + "/" + username + "/films/page/" + str(i + 1)
+            for i in range(1, num_of_pages)
+        ]
+
+        # executor.map yields in submission order, so pages stay in order
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            for content in executor.map(fetch_page, urls):
+                parse_films_page(BeautifulSoup(content, "html.parser"), movies_dict)
+
+    return pd.DataFrame(movies_dict).astype(FILM_DTYPES)
 
 
-@st.cache_data
 def score_index(rating_x, liked_x, rating_y, liked_y):
     if (rating_x == rating_y) & (liked_x == liked_y):
         score = 2.0
@@ -120,285 +184,150 @@ def score_index(rating_x, liked_x, rating_y, liked_y):
     return score
 
 
-def decade_year(year: int) -> str:
-    return str(int(year / 10) * 10) + "s"
-
-
-def classify_popularity(watched_by: int) -> str:
-    if watched_by <= 10000:
-        return "1 - very obscure"
-    elif watched_by <= 100000:
-        return "2 - obscure"
-    elif watched_by <= 1000000:
-        return "3 - popular"
-    else:
-        return "4 - very popular"
-
-
-@st.cache_data
-def classify_likeability(ltw_ratio):
-    if ltw_ratio <= 0.1:
-        return "1 - rarely likeable"
-    elif ltw_ratio <= 0.2:
-        return "2 - sometimes likeable"
-    elif ltw_ratio <= 0.4:
-        return "3 - often likeable"
-    else:
-        return "4 - usually likeable"
+# the classifiers below take and return whole columns, films without a year or
+# runtime get a missing label
+def decade_year(year: pd.Series) -> pd.Series:
+    decade = (year // 10 * 10).fillna(0).astype(int)
+    return (decade.astype(str) + "s").where(year.notna()).astype("category")
 
 
-@st.cache_data
-def classify_runtime(runtime):
-    if pd.isnull(runtime) != True:
-        if runtime < 30:
-            return "less than 30m"
-        elif runtime < 60:
-            return "30m-1h"
-        elif runtime < 90:
-            return "1h-1h 30m"
-        elif runtime < 120:
-            return "1h 30m-2h"
-        elif runtime < 150:
-            return "2h-2h 30m"
-        elif runtime < 180:
-            return "2h 30m-3h"
-        else:
-            return "at least 3h"
-    else:
-        return np.nan
+def classify_popularity(watched_by: pd.Series) -> pd.Series:
+    labels = ["1 - very obscure", "2 - obscure", "3 - popular", "4 - very popular"]
+    classes = np.select(
+        [watched_by <= 10000, watched_by <= 100000, watched_by <= 1000000],
+        labels[:3],
+        labels[3],
+    )
+    return pd.Series(pd.Categorical(classes, categories=labels), index=watched_by.index)
 
 
-@st.cache_data
-def scrape_films_details(df_film, username):
+def classify_likeability(ltw_ratio: pd.Series) -> pd.Series:
+    labels = [
+        "1 - rarely likeable",
+        "2 - sometimes likeable",
+        "3 - often likeable",
+        "4 - usually likeable",
+    ]
+    classes = np.select(
+        [ltw_ratio <= 0.1, ltw_ratio <= 0.2, ltw_ratio <= 0.4],
+        labels[:3],
+        labels[3],
+    )
+    return pd.Series(pd.Categorical(classes, categories=labels), index=ltw_ratio.index)
+
+
+def classify_runtime(runtime: pd.Series) -> pd.Series:
+    groups = pd.cut(
+        runtime,
+        bins=[-np.inf, 30, 60, 90, 120, 150, 180, np.inf],
+        right=False,
+        labels=[
+            "less than 30m",
+            "30m-1h",
+            "1h-1h 30m",
+            "1h 30m-2h",
+            "2h-2h 30m",
+            "2h 30m-3h",
+            "at least 3h",
+        ],
+    )
+    return groups
+
+
+def concat_cached_and_scraped(cached: DataFrame, scraped: DataFrame) -> DataFrame:
+    # skip empty frames so they don't affect the resulting dtypes
+    if len(scraped) == 0:
+        return cached
+    if len(cached) == 0:
+        return scraped
+    return pd.concat([cached, scraped], ignore_index=True)
+
+
+def scrape_films_details(
+    df_film,
+    username,
+    max_in_flight: int = DETAILS_MAX_IN_FLIGHT,
+    batch_size: int = DETAILS_BATCH_SIZE,
+):
+    # yields frames of film records as they arrive: all cached films at once,
+    # then the scraped ones in batches, so the dashboard can render early
     df_film = df_film[df_film["rating"] != -1].reset_index(drop=True)
-    num_of_films = len(df_film)
-
-    movies_rating = {}
-    movies_rating["id"] = []
-    movies_rating["avg_rating"] = []
-    movies_rating["year"] = []
-    movies_rating["watched_by"] = []
-    movies_rating["liked_by"] = []
-    movies_rating["runtime"] = []
-
-    movies_actor = {}
-    movies_actor["id"] = []
-    movies_actor["actor"] = []
-    movies_actor["actor_link"] = []
-
-    movies_director = {}
-    movies_director["id"] = []
-    movies_director["director"] = []
-    movies_director["director_link"] = []
-
-    movies_genre = {}
-    movies_genre["id"] = []
-    movies_genre["genre"] = []
-
-    movies_theme = {}
-    movies_theme["id"] = []
-    movies_theme["theme"] = []
-
-    movies_country = {}
-    movies_country["id"] = []
-    movies_country["country"] = []
-
-    movies_language = {}
-    movies_language["id"] = []
-    movies_language["language"] = []
-
-    progress = 0
-    bar = st.progress(progress)
-
-    print("loading cached films")
-    cached_films = fetch_cached_films_as_dataframe()
-    cached_films = cached_films[cached_films["id"].isin(df_film["id"])]
-    print(
-        f"cached films loaded successfully. {len(cached_films)} cached records found for user"
+    # the films cache and the scraped records keep the ids as strings
+    df_film = df_film.astype({"id": str})
+    progress = ProgressReporter(
+        len(df_film), f"film details [{username}]", st.progress(0).progress
     )
 
-    for _, cached_row in cached_films.iterrows():
-        progress = progress + 1
-        print("reading cached details of {} [{}]".format(cached_row["title"], username))
-
-        with st.spinner("scraping details of " + cached_row["title"]):
-            movies_rating["id"].append(cached_row["id"])
-            movies_rating["avg_rating"].append(cached_row["avg_rating"])
-            movies_rating["year"].append(cached_row["year"])
-            movies_rating["watched_by"].append(cached_row["watched_by"])
-            movies_rating["liked_by"].append(cached_row["liked_by"])
-            movies_rating["runtime"].append(cached_row["runtime"])
-
-            for actor in cached_row["actors"]:
-                movies_actor["id"].append(cached_row["id"])
-                movies_actor["actor"].append(actor["actor"])
-                movies_actor["actor_link"].append(actor["actor_link"])
-
-            for director in cached_row["directors"]:
-                movies_director["id"].append(cached_row["id"])
-                movies_director["director"].append(director["director"])
-                movies_director["director_link"].append(director["director_link"])
-
-            for genre in cached_row["genres"]:
-                movies_genre["id"].append(cached_row["id"])
-                movies_genre["genre"].append(genre)
-
-            for theme in cached_row["themes"]:
-                movies_theme["id"].append(cached_row["id"])
-                movies_theme["theme"].append(theme)
-
-            for country in cached_row["countries"]:
-                movies_country["id"].append(cached_row["id"])
-                movies_country["country"].append(country)
-
-            for language in cached_row["languages"]:
-                movies_language["id"].append(cached_row["id"])
-                movies_language["language"].append(language)
+    # films in the delta expire with the counters or the rating of the record
+    # cache, whichever expires first, then they are scraped again through it
+    record_cache = open_film_record_cache()
+    log("loading cached films")
+    cached_films = fetch_cached_films_as_dataframe(
+        df_film["id"],
+        CACHED_FILMS_COLUMNS,
+        min(record_cache.volatile_ttl, record_cache.rating_ttl),
+    )
+    log(
+        f"cached films loaded successfully. {len(cached_films)} cached records found for user"
+    )
 
-            bar.progress(progress / num_of_films)
+    progress.advance(len(cached_films))
+    if len(cached_films) > 0:
+        yield cached_films
 
     df_film = df_film[~df_film["id"].isin(cached_films["id"])]
 
-    for link in df_film["link"]:
-        progress = progress + 1
-        print(
-            "scraping details of {} [{}]".format(
-                df_film[df_film["link"] == link]["title"].values[0], username
-            )
-        )
-
-        with st.spinner(
-            "scraping details of " + df_film[df_film["link"] == link]["title"].values[0]
-        ):
-            id_movie = df_film[df_film["link"] == link]["id"].values[0]
-            url_movie = DOMAIN + link
-            url_movie_page = requests.get(url_movie)
-            if url_movie_page.status_code != 200:
-                encounter_error("")
-            soup_movie = BeautifulSoup(url_movie_page.content, "html.parser")
-            for sc in soup_movie.findAll("script"):
-                if sc.string != None:
-                    if "ratingValue" in sc.string:
-                        rating = sc.string.split("ratingValue")[1].split(",")[0][2:]
-                    if "releaseYear" in sc.string:
-                        year = (
-                            sc.string.split("releaseYear")[1]
-                            .split(",")[0][2:]
-                            .replace('"', "")
-                        )
-            url_stats = DOMAIN + "/csi" + link + "stats"
-            url_stats_page = requests.get(url_stats)
-            soup_stats = BeautifulSoup(url_stats_page.content, "html.parser")
-            watched_by = int(
-                soup_stats.findAll("li")[0]
-                .find("a")["title"]
-                .replace("\xa0", " ")
-                .split(" ")[2]
-                .replace(",", "")
-            )
-            liked_by = int(
-                soup_stats.findAll("li")[2]
-                .find("a")["title"]
-                .replace("\xa0", " ")
-                .split(" ")[2]
-                .replace(",", "")
-            )
-            try:
-                runtime = int(
-                    soup_movie.find("p", {"class": "text-link text-footer"})
-                    .get_text()
-                    .strip()
-                    .split("\xa0")[0]
-                )
-            except:
-                runtime = np.nan
-            movies_rating["id"].append(id_movie)
-            movies_rating["avg_rating"].append(rating)
-            movies_rating["year"].append(year)
-            movies_rating["watched_by"].append(watched_by)
-            movies_rating["liked_by"].append(liked_by)
-            movies_rating["runtime"].append(runtime)
-
-            # finding the actors
-            if soup_movie.find("div", {"class": "cast-list"}) != None:
-                for actor in soup_movie.find("div", {"class": "cast-list"}).findAll(
-                    "a"
-                ):
-                    if actor.get_text().strip() != "Show All…":
-                        movies_actor["id"].append(id_movie)
-                        movies_actor["actor"].append(actor.get_text().strip())
-                        movies_actor["actor_link"].append(actor["href"])
-
-            # finding the directors
-            if soup_movie.find("div", {"id": "tab-crew"}) != None:
-                for director in (
-                    soup_movie.find("div", {"id": "tab-crew"}).find("div").findAll("a")
-                ):
-                    movies_director["id"].append(id_movie)
-                    movies_director["director"].append(director.get_text().strip())
-                    movies_director["director_link"].append(director["href"])
-
-            # finding the genres
-            if soup_movie.find("div", {"id": "tab-genres"}) != None:
-                for genre in (
-                    soup_movie.find("div", {"id": "tab-genres"})
-                    .find("div")
-                    .findAll("a")
-                ):
-                    movies_genre["id"].append(id_movie)
-                    movies_genre["genre"].append(genre.get_text().strip())
-
-            # finding the themes
-            if soup_movie.find("div", {"id": "tab-genres"}) != None:
-                if "Themes" in str(soup_movie.find("div", {"id": "tab-genres"})):
-                    for theme in (
-                        soup_movie.find("div", {"id": "tab-genres"})
-                        .findAll("div")[1]
-                        .findAll("a")
-                    ):
-                        if theme.get_text().strip() != "Show All…":
-                            movies_theme["id"].append(id_movie)
-                            movies_theme["theme"].append(theme.get_text().strip())
-
-            # finding the countries
-            if soup_movie.find("div", {"id": "tab-details"}) != None:
-                if "Countr" in str(soup_movie.find("div", {"id": "tab-details"})):
-                    for country in (
-                        soup_movie.find("div", {"id": "tab-details"})
-                        .find("h3", string=lambda text: text and "Countr" in text)
-                        .find_next_sibling("div")
-                        .findAll("a")
-                    ):
-                        if country.get_text().strip() != "Show All…":
-                            movies_country["id"].append(id_movie)
-                            movies_country["country"].append(country.get_text().strip())
-
-            # finding the languages
-            if soup_movie.find("div", {"id": "tab-details"}) != None:
-                if "Language" in str(soup_movie.find("div", {"id": "tab-details"})):
-                    for language in (
-                        soup_movie.find("div", {"id": "tab-details"})
-                        .find("h3", string=lambda text: text and "Language" in text)
-                        .find_next_sibling("div")
-                        .findAll("a")
-                    ):
-                        if language.get_text().strip() != "Show All…":
-                            movies_language["id"].append(id_movie)
-                            movies_language["language"].append(
-                                language.get_text().strip()
-                            )
-
-        bar.progress(progress / num_of_films)
-    df_rating = pd.DataFrame(movies_rating)
-    df_rating["decade"] = df_rating.apply(
-        lambda row: decade_year(int(row["year"])), axis=1
+    film_records = film_parser.scrape_film_records(
+        df_film,
+        DOMAIN,
+        max_in_flight,
+        http_client.rate_limiter,
+        record_cache,
     )
-    df_actor = pd.DataFrame(movies_actor)
-    df_director = pd.DataFrame(movies_director)
-    df_genre = pd.DataFrame(movies_genre)
-    df_theme = pd.DataFrame(movies_theme)
-    df_country = pd.DataFrame(movies_country)
-    df_language = pd.DataFrame(movies_language)
+
+    scraped_films = []
+    batch = []
+    for film_record in film_records:
+        progress.advance(
+            message="scraping details of {} [{}]".format(film_record["title"], username)
+        )
+        scraped_films.append(film_record)
+        batch.append(film_record)
+        if len(batch) == batch_size:
+            yield pd.DataFrame(batch, columns=CACHED_FILMS_COLUMNS)
+            batch = []
+    if len(batch) > 0:
+        yield pd.DataFrame(batch, columns=CACHED_FILMS_COLUMNS)
+
+    log(f"http connections: {http_client.connection_stats}")
+    log(f"http requests: {http_client.request_metrics}")
+
+    # write scraped films back so the next user with them reads them as cached
+    if len(scraped_films) > 0:
+        delta_df = pd.DataFrame(scraped_films, columns=film_parser.FILM_RECORD_COLUMNS)
+        delta_df["last_modified_date"] = date.today()
+        films_cache.append_delta(delta_df)
+
+
+def build_films_details(films: DataFrame) -> tuple:
+    # cached and freshly scraped films share the same record shape
+    (
+        df_rating,
+        df_actor,
+        df_director,
+        df_genre,
+        df_theme,
+        df_country,
+        df_language,
+    ) = film_parser.flatten_film_records(films)
+    df_rating = df_rating.astype(RATING_DTYPES)
+    df_rating["decade"] = decade_year(df_rating["year"])
+    df_actor = df_actor.astype({"id": "int32"})
+    df_director = df_director.astype({"id": "int32"})
+    df_genre = df_genre.astype({"id": "int32", "genre": "category"})
+    df_theme = df_theme.astype({"id": "int32", "theme": "category"})
+    df_country = df_country.astype({"id": "int32", "country": "category"})
+    df_language = df_language.astype({"id": "int32", "language": "category"})
 
     return df_rating, df_actor, df_director, df_genre, df_theme, df_country, df_language
 